@@ -1,10 +1,12 @@
 from __future__ import annotations
 import os
-from datetime import datetime
-from typing import Optional, Dict, List, Iterator
-from sqlalchemy import create_engine, String, Integer, DateTime, ForeignKey, Text, UniqueConstraint
-from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship, sessionmaker, Session
-from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Optional, Dict, List, AsyncIterator
+from sqlalchemy import String, Integer, DateTime, ForeignKey, Text, UniqueConstraint, event, func
+from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 
 # --- Dual database configuration ---
 LEGACY_DB_URL = os.getenv("DATABASE_URL")
@@ -14,19 +16,73 @@ POSTGRES_DATABASE_URL = os.getenv("POSTGRES_DATABASE_URL") or (
 )
 DB_READ_PREFERENCE = os.getenv("DB_READ_PREFERENCE", "postgres").lower()
 
-engines: Dict[str, object] = {}
-sessions: Dict[str, sessionmaker] = {}
+# --- Postgres connection pool ---
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "20"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "30"))
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_QUERY_CACHE_SIZE = int(os.getenv("DB_QUERY_CACHE_SIZE", "1200"))
+
+# Plain URLs (as handed out by Render) are mapped onto their asyncio drivers
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgres": "postgresql+asyncpg",
+    "postgresql": "postgresql+asyncpg",
+}
+
+
+def to_async_url(url: str) -> str:
+    scheme, sep, rest = url.partition("://")
+    return f"{ASYNC_DRIVERS.get(scheme, scheme)}{sep}{rest}"
+
+
+# WAL lets readers run alongside the writer; NORMAL sync is durable under WAL
+# except on power loss; mmap and a 64 MiB page cache cut read syscalls.
+SQLITE_PRAGMAS = (
+    "journal_mode=WAL",
+    "synchronous=NORMAL",
+    "temp_store=MEMORY",
+    "mmap_size=268435456",
+    "cache_size=-65536",
+)
+
+
+def _apply_sqlite_pragmas(dbapi_connection, connection_record) -> None:
+    cursor = dbapi_connection.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(f"PRAGMA {pragma}")
+    cursor.close()
+
+
+engines: Dict[str, AsyncEngine] = {}
+sessions: Dict[str, async_sessionmaker[AsyncSession]] = {}
 
 if SQLITE_DATABASE_URL:
-    sqlite_connect_args = {"check_same_thread": False} if SQLITE_DATABASE_URL.startswith("sqlite") else {}
-    engines["sqlite"] = create_engine(SQLITE_DATABASE_URL, echo=False, future=True, connect_args=sqlite_connect_args)
-    sessions["sqlite"] = sessionmaker(bind=engines["sqlite"], autoflush=False, autocommit=False, future=True)
+    engines["sqlite"] = create_async_engine(
+        to_async_url(SQLITE_DATABASE_URL), echo=False, query_cache_size=DB_QUERY_CACHE_SIZE
+    )
+    if SQLITE_DATABASE_URL.startswith("sqlite"):
+        event.listen(engines["sqlite"].sync_engine, "connect", _apply_sqlite_pragmas)
+    sessions["sqlite"] = async_sessionmaker(bind=engines["sqlite"], autoflush=False, expire_on_commit=False)
 
 if POSTGRES_DATABASE_URL:
-    engines["postgres"] = create_engine(POSTGRES_DATABASE_URL, echo=False, future=True)
-    sessions["postgres"] = sessionmaker(bind=engines["postgres"], autoflush=False, autocommit=False, future=True)
+    engines["postgres"] = create_async_engine(
+        to_async_url(POSTGRES_DATABASE_URL),
+        echo=False,
+        query_cache_size=DB_QUERY_CACHE_SIZE,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=True,
+        pool_use_lifo=True,
+    )
+    sessions["postgres"] = async_sessionmaker(bind=engines["postgres"], autoflush=False, expire_on_commit=False)
 
 
+# Timestamps come from the database clock: default=func.now() renders NOW() into each
+# INSERT/UPDATE (so tables created before server_default existed keep working) and
+# server_default covers rows written outside the ORM.
 class Base(DeclarativeBase):
     pass
 
@@ -35,31 +91,37 @@ class User(Base):
     __tablename__ = "users"
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
     user_id: Mapped[str] = mapped_column(String(128), unique=True, index=True)
-    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
-    likes: Mapped[list[UserLikedSong]] = relationship("UserLikedSong", back_populates="user", cascade="all, delete-orphan")
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=func.now(), server_default=func.now())
+    # lazy="raise": related rows must be loaded explicitly (e.g. selectinload) instead of one query per access
+    likes: Mapped[list[UserLikedSong]] = relationship(
+        "UserLikedSong", back_populates="user", cascade="all, delete-orphan", lazy="raise"
+    )
 
 
 class UserLikedSong(Base):
     __tablename__ = "user_liked_songs"
+    # uq_user_song leads with user_id, so it also serves per-user lookups in song_name order
     __table_args__ = (
         UniqueConstraint("user_id", "song_name", name="uq_user_song"),
     )
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
     user_id: Mapped[int] = mapped_column(ForeignKey("users.id", ondelete="CASCADE"))
-    song_name: Mapped[str] = mapped_column(String(512), index=True)
-    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
-    user: Mapped[User] = relationship("User", back_populates="likes")
+    song_name: Mapped[str] = mapped_column(String(512))
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=func.now(), server_default=func.now())
+    user: Mapped[User] = relationship("User", back_populates="likes", lazy="raise")
 
 
-class QueryCache(Base):
-    __tablename__ = "query_cache"
+# Ordered video ids returned by the YouTube search for a normalized song name;
+# the first id is the seed, the rest are its candidates
+class SearchResult(Base):
+    __tablename__ = "search_results"
     __table_args__ = (
-        UniqueConstraint("query", name="uq_query"),
+        UniqueConstraint("query", name="uq_search_query"),
     )
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
-    query: Mapped[str] = mapped_column(String(512), index=True)
-    best_video_id: Mapped[str] = mapped_column(String(64))
-    updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    query: Mapped[str] = mapped_column(String(512))
+    video_ids: Mapped[str] = mapped_column(Text)
+    updated_at: Mapped[datetime] = mapped_column(DateTime, default=func.now(), server_default=func.now(), onupdate=func.now())
 
 
 class VideoFeature(Base):
@@ -68,47 +130,51 @@ class VideoFeature(Base):
         UniqueConstraint("video_id", name="uq_video_id"),
     )
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
-    video_id: Mapped[str] = mapped_column(String(64), index=True)
+    video_id: Mapped[str] = mapped_column(String(64))
     title: Mapped[str] = mapped_column(String(512))
     channel_title: Mapped[str] = mapped_column(String(256))
     tags: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
     description: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
     view_count: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
     duration: Mapped[Optional[str]] = mapped_column(String(32), nullable=True)
-    updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    updated_at: Mapped[datetime] = mapped_column(DateTime, default=func.now(), server_default=func.now(), onupdate=func.now())
 
 
-def init_db() -> None:
+# Both dialects expose the same on_conflict_do_update/do_nothing API for upserts
+def dialect_insert(session: AsyncSession):
+    return pg_insert if session.bind.dialect.name == "postgresql" else sqlite_insert
+
+
+# Freshness cutoffs are computed on the same database clock that writes
+# updated_at, so they don't depend on app/DB skew or the Postgres TimeZone
+def db_now_minus(session: AsyncSession, seconds: int):
+    if session.bind.dialect.name == "postgresql":
+        return func.now() - timedelta(seconds=seconds)
+    return func.datetime("now", f"-{int(seconds)} seconds")
+
+
+async def init_db() -> None:
     for eng in engines.values():
-        Base.metadata.create_all(bind=eng)
-
-@contextmanager
-def get_read_session() -> Iterator[Session]:
-    session = None
-    try:
-        # Prefer configured read DB, fallback to available
-        if DB_READ_PREFERENCE == "postgres" and "postgres" in sessions:
-            session = sessions["postgres"]()
-        elif DB_READ_PREFERENCE == "sqlite" and "sqlite" in sessions:
-            session = sessions["sqlite"]()
-        elif "postgres" in sessions:
-            session = sessions["postgres"]()
-        else:
-            session = sessions["sqlite"]()
+        async with eng.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+
+def primary_db_name() -> str:
+    # Prefer configured read DB, fallback to available
+    if DB_READ_PREFERENCE == "postgres" and "postgres" in sessions:
+        return "postgres"
+    if DB_READ_PREFERENCE == "sqlite" and "sqlite" in sessions:
+        return "sqlite"
+    return "postgres" if "postgres" in sessions else "sqlite"
+
+async def get_read_session() -> AsyncIterator[AsyncSession]:
+    async with sessions[primary_db_name()]() as session:
         yield session
-    finally:
-        if session:
-            session.close()
-
-@contextmanager
-def get_write_sessions() -> Iterator[List[Session]]:
-    sessions_list = []
-    try:
-        if "sqlite" in sessions:
-            sessions_list.append(sessions["sqlite"]())
-        if "postgres" in sessions:
-            sessions_list.append(sessions["postgres"]())
-        yield sessions_list
-    finally:
-        for s in sessions_list:
-            s.close()
+
+async def get_write_session() -> AsyncIterator[AsyncSession]:
+    # Writes go to the database reads come from, so a request sees its own writes
+    async with sessions[primary_db_name()]() as session:
+        yield session
+
+def replica_sessionmakers() -> List[async_sessionmaker]:
+    # The other configured databases, kept in sync after the primary commits
+    return [factory for name, factory in sessions.items() if name != primary_db_name()]
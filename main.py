@@ -1,32 +1,81 @@
 import os
-import requests
+import asyncio
+import httpx
 import logging
-from typing import List, Optional, Dict, Tuple
-from functools import lru_cache
+from contextlib import asynccontextmanager
+from typing import List, Optional, Dict, Tuple, Set, Callable, Awaitable
 from dotenv import load_dotenv
-from fastapi import FastAPI, HTTPException, Query, Depends
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, HTTPException, Query, Depends, BackgroundTasks
+from fastapi.responses import ORJSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-import redis
+import redis.asyncio as redis
 import json
+import orjson
 import time
-import urllib.parse
 import re
 import random
-from sqlalchemy.orm import Session
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
-from db import init_db, get_read_session, get_write_sessions, User, UserLikedSong, QueryCache
+import heapq
+import hashlib
+from operator import itemgetter
+from functools import lru_cache
+from cachetools import LRUCache, TTLCache
+from aiolimiter import AsyncLimiter
+from sqlalchemy import select, delete, bindparam, func
+from sqlalchemy.orm import selectinload
+from sqlalchemy.ext.asyncio import AsyncSession
+import numpy as np
+from sklearn.feature_extraction.text import HashingVectorizer
+from db import init_db, get_read_session, get_write_session, replica_sessionmakers, dialect_insert, db_now_minus, User, UserLikedSong, SearchResult, VideoFeature
 
 # Load environment variables
 load_dotenv()
 
+# Startup and shutdown; the helpers it uses are defined further down
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global redis_client, video_details_batcher
+    await init_db()
+    if redis_client:
+        try:
+            await redis_client.ping()
+            logger.info("Connected to Redis successfully.")
+        except Exception as e:
+            logger.error("Failed to initialize Redis: %s", e)
+            await redis_client.aclose()
+            redis_client = None
+    popular_chart_task = None
+    if YOUTUBE_API_KEY:
+        popular_chart_task = asyncio.create_task(refresh_popular_chart())
+        video_details_batcher = VideoDetailsBatcher(
+            fetch=get_suggestion_service().fetch_video_details_batch,
+            max_batch=YOUTUBE_MAX_IDS_PER_REQUEST,
+            max_wait=VIDEO_DETAILS_BATCH_WINDOW_SECONDS
+        )
+        video_details_batcher.start()
+    # Rebuild the shared service now that Redis and the batcher are settled
+    get_suggestion_service.cache_clear()
+
+    yield
+
+    if popular_chart_task:
+        popular_chart_task.cancel()
+    if video_details_batcher:
+        video_details_batcher.stop()
+        video_details_batcher = None
+    get_suggestion_service.cache_clear()
+    await http_client.aclose()
+    if redis_client:
+        await redis_client.aclose()
+
+
 # Initialize FastAPI app
 app = FastAPI(
     title="Enhanced Music Suggestion API",
     description="API to manage liked songs and get music suggestions based on multiple liked songs using YouTube Data API. Includes a fallback to popular songs.",
-    version="1.2.0"
+    version="1.2.0",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
 )
 
 # Configure CORS
@@ -46,21 +95,94 @@ logger = logging.getLogger(__name__)
 YOUTUBE_API_KEY = os.getenv("YOUTUBE_API_KEY")
 REDIS_URL = os.getenv("REDIS_URL")
 REDIS_TTL_SECONDS = int(os.getenv("REDIS_TTL_SECONDS", "3600"))
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "32"))
+REDIS_POOL_TIMEOUT_SECONDS = float(os.getenv("REDIS_POOL_TIMEOUT_SECONDS", "5"))
+LIKED_SONGS_CACHE_TTL_SECONDS = int(os.getenv("LIKED_SONGS_CACHE_TTL_SECONDS", "30"))
+VIDEO_FEATURE_TTL_SECONDS = int(os.getenv("VIDEO_FEATURE_TTL_SECONDS", "86400"))
+SEARCH_RESULT_TTL_SECONDS = int(os.getenv("SEARCH_RESULT_TTL_SECONDS", "604800"))
+YOUTUBE_MAX_REQUESTS_PER_MINUTE = int(os.getenv("YOUTUBE_MAX_REQUESTS_PER_MINUTE", "100"))
+
+YOUTUBE_SEARCH_URL = "https://www.googleapis.com/youtube/v3/search"
+YOUTUBE_VIDEOS_URL = "https://www.googleapis.com/youtube/v3/videos"
+# videos.list accepts at most 50 comma-separated ids per call
+YOUTUBE_MAX_IDS_PER_REQUEST = 50
+# How long a details batch waits for ids from other in-flight requests
+VIDEO_DETAILS_BATCH_WINDOW_SECONDS = 0.01
+# Partial responses: ask YouTube only for the fields the service reads
+# (_youtube_get also sends prettyPrint=false to drop indentation whitespace)
+SEARCH_FIELDS = "items(id/videoId)"
+DETAILS_FIELDS = "items(id,snippet(title,channelTitle,description,tags))"
+POPULAR_FIELDS = "items(id,snippet(title,channelTitle))"
+
+# Per-song ranked suggestions keyed on the normalized song name, shared across
+# requests so overlapping song lists reuse each other's lookups
+SONG_CACHE_MAXSIZE = int(os.getenv("SONG_CACHE_MAXSIZE", "1024"))
+song_suggestion_cache: TTLCache = TTLCache(maxsize=SONG_CACHE_MAXSIZE, ttl=REDIS_TTL_SECONDS)
+# The most-popular music chart changes slowly; a background task refreshes it
+# at half the TTL so fallbacks never wait on YouTube, and each fallback still
+# picks its own random song from it
+popular_chart_cache: TTLCache = TTLCache(maxsize=1, ttl=REDIS_TTL_SECONDS)
+POPULAR_CHART_REFRESH_SECONDS = max(REDIS_TTL_SECONDS // 2, 60)
+# Per-song fetches in flight in this worker, keyed like song_suggestion_cache
+song_suggestions_inflight: Dict[str, asyncio.Future] = {}
 
 # Validate API key at startup
 if not YOUTUBE_API_KEY:
     logger.warning("YouTube API key not found. Please set YOUTUBE_API_KEY environment variable.")
 
-# Optional Redis client
-redis_client: Optional[redis.Redis] = None
-if REDIS_URL:
-    try:
-        redis_client = redis.from_url(REDIS_URL, decode_responses=True)
-        redis_client.ping()
-        logger.info("Connected to Redis successfully.")
-    except Exception as e:
-        logger.error(f"Failed to initialize Redis: {e}")
-        redis_client = None
+# Optional Redis client (asyncio) over a bounded connection pool: connections
+# are opened lazily, callers wait for a free one once the pool is exhausted
+# (rather than failing), and the lifespan pings it once at startup
+redis_client: Optional[redis.Redis] = redis.Redis(
+    connection_pool=redis.BlockingConnectionPool.from_url(
+        REDIS_URL,
+        decode_responses=False,
+        max_connections=REDIS_MAX_CONNECTIONS,
+        timeout=REDIS_POOL_TIMEOUT_SECONDS
+    )
+) if REDIS_URL else None
+
+# Shared HTTP client: YouTube calls reuse pooled keep-alive connections and are
+# multiplexed over HTTP/2 when googleapis.com negotiates it
+http_client = httpx.AsyncClient(
+    http2=True,
+    timeout=5.0,
+    limits=httpx.Limits(max_connections=50, max_keepalive_connections=20)
+)
+
+# Per-process cap on outgoing YouTube calls; waiting callers yield to the event
+# loop instead of blocking other requests
+youtube_limiter = AsyncLimiter(YOUTUBE_MAX_REQUESTS_PER_MINUTE, 60)
+# Last ETag and body per YouTube search/chart request (URL plus sorted params),
+# replayed on 304 Not Modified
+youtube_etag_cache: LRUCache = LRUCache(maxsize=int(os.getenv("YOUTUBE_ETAG_CACHE_SIZE", "1024")))
+
+# Retries for throttled or failing YouTube calls: exponential backoff with full
+# jitter so concurrent callers don't retry in lockstep, or the server's
+# Retry-After when it sends one
+YOUTUBE_MAX_ATTEMPTS = int(os.getenv("YOUTUBE_MAX_ATTEMPTS", "3"))
+YOUTUBE_RETRY_BASE_DELAY_SECONDS = 0.5
+YOUTUBE_RETRY_MAX_DELAY_SECONDS = 8.0
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+def backoff_delay(attempt: int) -> float:
+    return random.uniform(0, min(YOUTUBE_RETRY_MAX_DELAY_SECONDS,
+                                 YOUTUBE_RETRY_BASE_DELAY_SECONDS * 2 ** (attempt - 1)))
+
+def retry_after_delay(resp: httpx.Response, attempt: int) -> Optional[float]:
+    retry_after = resp.headers.get("Retry-After", "")
+    if not retry_after.isdigit():
+        return backoff_delay(attempt)
+    # Waiting longer than the cap would hold the user's request open; give up instead
+    delay = float(retry_after)
+    return delay if delay <= YOUTUBE_RETRY_MAX_DELAY_SECONDS else None
+
+# Stateless text vectorizer shared by every ranking call: hashing needs no
+# per-request vocabulary fit
+text_vectorizer = HashingVectorizer(n_features=2 ** 15, alternate_sign=False, norm="l2", stop_words="english")
+
+# Started on startup when YouTube is configured; see VideoDetailsBatcher
+video_details_batcher: Optional["VideoDetailsBatcher"] = None
 
 # Pydantic models
 class Song(BaseModel):
@@ -77,72 +199,346 @@ class SuggestionResponse(BaseModel):
 
 class LikedSongsResponse(BaseModel):
     liked_songs: List[str]
+    next_cursor: Optional[str] = None
 
 class LikedSongsRequest(BaseModel):
     user_id: str
     songs: List[str]
 
 
-@app.on_event("startup")
-def on_startup() -> None:
-    init_db()
+# --- REPOSITORY PATTERN ---
+# Statements are built once at import so every request reuses the same
+# compiled SQL from the engine's statement cache.
+USER_WITH_LIKES_BY_ID_STMT = (
+    select(User).where(User.user_id == bindparam("user_id")).options(selectinload(User.likes))
+)
+LIKES_BY_USER_STMT = (
+    select(UserLikedSong.song_name)
+    .join(User, User.id == UserLikedSong.user_id)
+    .where(User.user_id == bindparam("user_id"))
+    .order_by(UserLikedSong.song_name)
+)
 
 
-# --- REPOSITORY PATTERN ---
 # This class centralizes all database logic.
 class UserRepository:
-    def __init__(self, db: Session):
+    def __init__(self, db: AsyncSession):
         self.db = db
 
-    def get_liked_songs(self, user_id: str) -> List[str]:
-        user = self.db.query(User).filter_by(user_id=user_id).one_or_none()
-        if not user:
-            return []
-        rows = self.db.query(UserLikedSong).filter_by(user_id=user.id).all()
-        return [r.song_name for r in rows]
-
-    def persist_user_likes(self, user_id: str, songs: List[str]) -> None:
-        user = self.db.query(User).filter_by(user_id=user_id).one_or_none()
+    async def get_liked_songs(self, user_id: str, limit: Optional[int] = None,
+                              after: Optional[str] = None) -> List[str]:
+        # Keyset pagination on song_name, which uq_user_song already orders per user
+        stmt = LIKES_BY_USER_STMT
+        if after is not None:
+            stmt = stmt.where(UserLikedSong.song_name > after)
+        if limit is not None:
+            stmt = stmt.limit(limit)
+        # One joined query; an unknown user simply yields no rows
+        rows = await self.db.scalars(stmt, {"user_id": user_id})
+        return list(rows)
+
+    async def persist_user_likes(self, user_id: str, songs: List[str]) -> None:
+        # Lazy loads are not available on AsyncSession, so load the likes up front
+        user = await self.db.scalar(USER_WITH_LIKES_BY_ID_STMT, {"user_id": user_id})
         if not user:
-            user = User(user_id=user_id)
+            user = User(user_id=user_id, likes=[])
             self.db.add(user)
-            self.db.flush()
+            await self.db.flush()
 
         existing_likes = {s.song_name for s in user.likes}
         new_likes = set(songs)
 
         songs_to_delete = existing_likes - new_likes
-        if songs_to_delete:
-            self.db.query(UserLikedSong).filter(
-                UserLikedSong.user_id == user.id,
-                UserLikedSong.song_name.in_(songs_to_delete)
-            ).delete(synchronize_session='fetch')
+        songs_to_keep = existing_likes & new_likes
+        # The loaded likes are not read again, so both deletes skip syncing the
+        # identity map (synchronize_session=False: no extra SELECT of the rows)
+        if len(songs_to_keep) < len(songs_to_delete):
+            # Mostly replaced: list the shorter set of kept songs rather than the
+            # removed ones; kept rows retain their ids and created_at
+            criteria = [UserLikedSong.user_id == user.id]
+            if songs_to_keep:
+                criteria.append(UserLikedSong.song_name.not_in(songs_to_keep))
+            await self.db.execute(
+                delete(UserLikedSong).where(*criteria)
+                .execution_options(synchronize_session=False)
+            )
+        elif songs_to_delete:
+            await self.db.execute(
+                delete(UserLikedSong).where(
+                    UserLikedSong.user_id == user.id,
+                    UserLikedSong.song_name.in_(songs_to_delete)
+                ).execution_options(synchronize_session=False)
+            )
 
         songs_to_add = new_likes - existing_likes
-        for s in songs_to_add:
-            self.db.add(UserLikedSong(user_id=user.id, song_name=s))
+        if songs_to_add:
+            # One multi-row INSERT; rows a concurrent request already added are skipped
+            await self.db.execute(
+                dialect_insert(self.db)(UserLikedSong)
+                .values([{"user_id": user.id, "song_name": s} for s in songs_to_add])
+                .on_conflict_do_nothing(index_elements=[UserLikedSong.user_id, UserLikedSong.song_name])
+            )
+
+        await self.db.commit()
+
+
+# Durable cache of YouTube data on the primary DB: search results per song
+# (search.list is the expensive quota call) and video snippets per id.
+class YouTubeCacheRepository:
+    def __init__(self, db: AsyncSession):
+        self.db = db
 
-        self.db.commit()
+    async def get_fresh_searches(self, queries: List[str], max_age_seconds: int) -> Dict[str, List[str]]:
+        cutoff = db_now_minus(self.db, max_age_seconds)
+        rows = await self._read_and_release(
+            select(SearchResult.query, SearchResult.video_ids).where(
+                SearchResult.query.in_(queries),
+                SearchResult.updated_at >= cutoff
+            )
+        )
+        return {query: video_ids.split(",") for query, video_ids in rows}
+
+    async def save_searches(self, searches: Dict[str, List[str]]) -> None:
+        if not searches:
+            return
+        stmt = dialect_insert(self.db)(SearchResult).values(
+            [{"query": query, "video_ids": ",".join(ids)} for query, ids in searches.items()]
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[SearchResult.query],
+            set_={"video_ids": stmt.excluded.video_ids, "updated_at": func.now()}
+        )
+        await self._execute_and_commit(stmt)
+
+    async def get_fresh_details(self, video_ids: List[str], max_age_seconds: int) -> Dict[str, dict]:
+        cutoff = db_now_minus(self.db, max_age_seconds)
+        rows = await self._read_and_release(
+            select(VideoFeature.video_id, VideoFeature.title, VideoFeature.channel_title,
+                   VideoFeature.description, VideoFeature.tags).where(
+                VideoFeature.video_id.in_(video_ids),
+                VideoFeature.updated_at >= cutoff
+            )
+        )
+        return {
+            video_id: {"title": title, "channel_title": channel_title,
+                       "description": description or "", "tags": json.loads(tags) if tags else []}
+            for video_id, title, channel_title, description, tags in rows
+        }
+
+    async def save_details(self, details_map: Dict[str, dict]) -> None:
+        if not details_map:
+            return
+        rows = [{
+            "video_id": video_id,
+            "title": details["title"],
+            "channel_title": details["channel_title"],
+            "description": details["description"] or None,
+            "tags": json.dumps(details["tags"]) if details["tags"] else None
+        } for video_id, details in details_map.items()]
+        stmt = dialect_insert(self.db)(VideoFeature).values(rows)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[VideoFeature.video_id],
+            set_={
+                "title": stmt.excluded.title,
+                "channel_title": stmt.excluded.channel_title,
+                "description": stmt.excluded.description,
+                "tags": stmt.excluded.tags,
+                "updated_at": func.now()
+            }
+        )
+        await self._execute_and_commit(stmt)
+
+    async def _read_and_release(self, stmt) -> list:
+        # Callers go on to YouTube (rate-limiter waits, retries), so end the read
+        # transaction here; otherwise the pooled connection sits idle in
+        # transaction until the following write commits
+        try:
+            return (await self.db.execute(stmt)).all()
+        finally:
+            await self.db.rollback()
+
+    async def _execute_and_commit(self, stmt) -> None:
+        # The session is shared with the rest of the request; a failed upsert
+        # (e.g. a deadlock between overlapping upserts) must not leave it aborted
+        try:
+            await self.db.execute(stmt)
+            await self.db.commit()
+        except Exception:
+            await self.db.rollback()
+            raise
+
+
+_PUNCT_RE = re.compile(r'[^\w\s]')
+_WS_RE = re.compile(r'\s+')
+
+def normalize_song_name(song_name: str) -> str:
+    # Collapse the gaps left by removed punctuation ("a - b" -> "a b")
+    return _WS_RE.sub(' ', _PUNCT_RE.sub('', song_name)).lower().strip()
+
+
+# --- CACHE-ASIDE FOR LIKED SONGS ---
+# Entries are dropped whenever a user's likes are rewritten; the short TTL only
+# bounds a read that races with that invalidation.
+class LikedSongsCache:
+    def __init__(self, redis_client: Optional[redis.Redis], ttl: int):
+        self.redis_client = redis_client
+        self.ttl = ttl
+
+    async def get(self, user_id: str) -> Optional[List[str]]:
+        if not self.redis_client:
+            return None
+        try:
+            val = await self.redis_client.get(f"liked:{user_id}")
+            return orjson.loads(val) if val else None
+        except Exception as e:
+            logger.warning("Redis get failed: %s", e)
+            return None
+
+    async def set(self, user_id: str, songs: List[str]) -> None:
+        if not self.redis_client:
+            return
+        try:
+            await self.redis_client.setex(f"liked:{user_id}", self.ttl, orjson.dumps(songs))
+        except Exception as e:
+            logger.warning("Redis set failed: %s", e)
+
+    async def invalidate(self, user_id: str) -> None:
+        if not self.redis_client:
+            return
+        try:
+            await self.redis_client.delete(f"liked:{user_id}")
+        except Exception as e:
+            logger.warning("Redis delete failed: %s", e)
+
+
+# --- MICRO-BATCHING FOR VIDEO DETAILS ---
+# Detail lookups from concurrent requests are queued and merged into shared
+# videos.list calls: a batch closes at max_batch distinct ids or max_wait
+# seconds after its first id, whichever comes first.
+class VideoDetailsBatcher:
+    def __init__(self, fetch: Callable[[List[str]], Awaitable[Dict[str, dict]]],
+                 max_batch: int, max_wait: float):
+        self.fetch = fetch
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.worker: Optional[asyncio.Task] = None
+        self.pending: Set[asyncio.Task] = set()
+
+    def start(self) -> None:
+        self.worker = asyncio.create_task(self._collect_batches())
+
+    def stop(self) -> None:
+        if self.worker:
+            self.worker.cancel()
+        for task in self.pending:
+            task.cancel()
+
+    async def get_many(self, video_ids: List[str]) -> Dict[str, dict]:
+        loop = asyncio.get_running_loop()
+        futures = {vid: loop.create_future() for vid in dict.fromkeys(video_ids)}
+        for vid, fut in futures.items():
+            self.queue.put_nowait((vid, fut))
+        details: Dict[str, dict] = {}
+        for vid, fut in futures.items():
+            item = await fut
+            if item is not None:
+                details[vid] = item
+        return details
+
+    async def _collect_batches(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            vid, fut = await self.queue.get()
+            waiters: Dict[str, List[asyncio.Future]] = {vid: [fut]}
+            deadline = loop.time() + self.max_wait
+            while len(waiters) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    vid, fut = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                waiters.setdefault(vid, []).append(fut)
+            # Fetch in the background so the next batch starts collecting now
+            task = asyncio.create_task(self._fetch_batch(waiters))
+            self.pending.add(task)
+            task.add_done_callback(self.pending.discard)
+
+    async def _fetch_batch(self, waiters: Dict[str, List[asyncio.Future]]) -> None:
+        details: Dict[str, dict] = {}
+        try:
+            details = await self.fetch(list(waiters))
+        finally:
+            for vid, futures in waiters.items():
+                for fut in futures:
+                    if not fut.done():
+                        fut.set_result(details.get(vid))
 
 
 # --- SERVICE PATTERN ---
 # This class contains the core business logic for suggestions.
 class SuggestionService:
-    def __init__(self, api_key: str, redis_client: Optional[redis.Redis], redis_ttl: int):
+    def __init__(self, api_key: str, redis_client: Optional[redis.Redis], redis_ttl: int,
+                 http_client: httpx.AsyncClient, details_batcher: Optional[VideoDetailsBatcher] = None):
         self.api_key = api_key
         self.redis_client = redis_client
         self.redis_ttl = redis_ttl
+        self.http_client = http_client
+        self.details_batcher = details_batcher
+
+    async def _youtube_get(self, url: str, params: Dict[str, str], timeout: float) -> httpx.Response:
+        params = {**params, "prettyPrint": "false", "key": self.api_key}
+        # Detail batches (videos.list by id) are assembled from whatever ids are
+        # missing at the time, so their bodies are large and rarely requested
+        # again; only searches and the chart are revalidated
+        cache_key = None if "id" in params else (url, tuple(sorted(params.items())))
+        cached = youtube_etag_cache.get(cache_key) if cache_key else None
+        headers = {"If-None-Match": cached[0]} if cached else None
+        for attempt in range(1, YOUTUBE_MAX_ATTEMPTS + 1):
+            try:
+                async with youtube_limiter:
+                    resp = await self.http_client.get(url, params=params, timeout=timeout, headers=headers)
+            except httpx.TransportError:
+                if attempt == YOUTUBE_MAX_ATTEMPTS:
+                    raise
+                await asyncio.sleep(backoff_delay(attempt))
+                continue
+            if resp.status_code not in RETRYABLE_STATUS_CODES or attempt == YOUTUBE_MAX_ATTEMPTS:
+                break
+            delay = retry_after_delay(resp, attempt)
+            if delay is None:
+                break
+            logger.warning("YouTube returned %s, retrying in %.2fs", resp.status_code, delay)
+            await asyncio.sleep(delay)
+        if resp.status_code == 304 and cached:
+            # Unchanged since the last fetch: replay the stored body
+            return httpx.Response(200, content=cached[1], request=resp.request)
+        etag = resp.headers.get("ETag")
+        if resp.status_code == 200 and etag and cache_key:
+            youtube_etag_cache[cache_key] = (etag, resp.content)
+        return resp
+
+    async def get_popular_chart_items(self, refresh: bool = False) -> List[dict]:
+        items = None if refresh else popular_chart_cache.get("items")
+        if items is not None:
+            return items
+        resp = await self._youtube_get(YOUTUBE_VIDEOS_URL, {
+            "part": "snippet", "chart": "mostPopular", "videoCategoryId": "10",
+            "maxResults": "50", "fields": POPULAR_FIELDS
+        }, timeout=10)
+        if resp.status_code != 200:
+            logger.error("Fallback API error: %s - %s", resp.status_code, resp.text)
+            return []
+        items = orjson.loads(resp.content).get('items', [])
+        if items:
+            popular_chart_cache["items"] = items
+        return items
 
-    def get_popular_song_fallback(self) -> Optional[List[dict]]:
+    async def get_popular_song_fallback(self) -> Optional[List[dict]]:
         try:
-            fallback_url = (f"https://www.googleapis.com/youtube/v3/videos?part=snippet,statistics"
-                            f"&chart=mostPopular&videoCategoryId=10&maxResults=50&key={self.api_key}")
-            resp = requests.get(fallback_url, timeout=10)
-            if resp.status_code != 200:
-                logger.error(f"Fallback API error: {resp.status_code} - {resp.text}")
-                return None
-            
-            items = resp.json().get('items', [])
+            items = await self.get_popular_chart_items()
             if not items:
                 logger.warning("Fallback could not retrieve any popular songs.")
                 return None
@@ -154,144 +550,319 @@ class SuggestionService:
                 "youtube_video_id": song["id"],
                 "score": 1.0
             }]
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Network error during fallback search: {str(e)}")
+        except httpx.HTTPError as e:
+            logger.error("Network error during fallback search: %s", e)
+            return None
+        except Exception:
+            logger.exception("Unexpected error during fallback search")
             return None
 
-    @lru_cache(maxsize=128)
-    def get_youtube_suggestions(self, song_name: str) -> Optional[List[dict]]:
+    async def search_song_videos(self, query: str) -> Optional[List[str]]:
         try:
-            song_name = re.sub(r'[^\w\s]', '', song_name).lower().strip()
-            query = urllib.parse.quote(f"{song_name} official music video")
-            search_url = (f"https://www.googleapis.com/youtube/v3/search?part=snippet&q={query}&type=video"
-                          f"&videoCategoryId=10&maxResults=5&key={self.api_key}")
-            resp = requests.get(search_url, timeout=5)
+            resp = await self._youtube_get(YOUTUBE_SEARCH_URL, {
+                "part": "snippet", "q": f"{query} official music video", "type": "video",
+                "videoCategoryId": "10", "maxResults": "20", "fields": SEARCH_FIELDS
+            }, timeout=5)
             if resp.status_code != 200: return None
-            items = resp.json().get('items', [])
-            if not items: return None
-
-            original_video = items[0]
-            original_video_id = original_video["id"]["videoId"]
-            seed_text = " ".join([original_video["snippet"].get("title", ""), original_video["snippet"].get("channelTitle", "")])
-
-            related_url = (f"https://www.googleapis.com/youtube/v3/search?part=snippet&relatedToVideoId={original_video_id}"
-                           f"&type=video&videoCategoryId=10&maxResults=20&key={self.api_key}")
-            related_resp = requests.get(related_url, timeout=5)
-            if related_resp.status_code != 200: return None
-            related_items = related_resp.json().get('items', [])
-            if not related_items: return None
+            items = orjson.loads(resp.content).get('items', [])
+            video_ids = [it["id"]["videoId"] for it in items if "videoId" in it.get("id", {})]
+            return video_ids or None
+        except Exception as e:
+            logger.error("Unexpected error searching for %s: %s", query, e)
+            return None
 
-            related_ids = [it["id"]["videoId"] for it in related_items if "videoId" in it.get("id", {})]
-            if not related_ids: return None
+    async def get_video_details(self, video_ids: List[str],
+                                youtube_cache: Optional[YouTubeCacheRepository] = None) -> Dict[str, dict]:
+        unique_ids = list(dict.fromkeys(video_ids))
+        details_map: Dict[str, dict] = {}
+        if youtube_cache:
+            try:
+                details_map = await youtube_cache.get_fresh_details(unique_ids, VIDEO_FEATURE_TTL_SECONDS)
+            except Exception as e:
+                logger.warning("Video feature lookup failed: %s", e)
+
+        misses = [vid for vid in unique_ids if vid not in details_map]
+        if misses:
+            fetched = await self.fetch_video_details(misses)
+            details_map.update(fetched)
+            if youtube_cache and fetched:
+                try:
+                    await youtube_cache.save_details(fetched)
+                except Exception as e:
+                    logger.warning("Video feature write failed: %s", e)
+        return details_map
+
+    async def fetch_video_details(self, video_ids: List[str]) -> Dict[str, dict]:
+        if self.details_batcher:
+            return await self.details_batcher.get_many(video_ids)
+        chunks = [video_ids[i:i + YOUTUBE_MAX_IDS_PER_REQUEST]
+                  for i in range(0, len(video_ids), YOUTUBE_MAX_IDS_PER_REQUEST)]
+        details_map: Dict[str, dict] = {}
+        for chunk_details in await asyncio.gather(*(self.fetch_video_details_batch(c) for c in chunks)):
+            details_map.update(chunk_details)
+        return details_map
+
+    async def fetch_video_details_batch(self, video_ids: List[str]) -> Dict[str, dict]:
+        try:
+            details_resp = await self._youtube_get(YOUTUBE_VIDEOS_URL, {
+                "part": "snippet", "id": ",".join(video_ids), "fields": DETAILS_FIELDS
+            }, timeout=8)
+            if details_resp.status_code != 200:
+                logger.error("Video details API error: %s - %s", details_resp.status_code, details_resp.text)
+                return {}
+            # Keep only the flat fields ranking reads, not the nested API items
+            details_map = {}
+            for item in orjson.loads(details_resp.content).get("items", []):
+                snippet = item.get("snippet", {})
+                details_map[item["id"]] = {
+                    "title": snippet.get("title", ""),
+                    "channel_title": snippet.get("channelTitle", ""),
+                    "description": snippet.get("description", ""),
+                    "tags": snippet.get("tags", [])
+                }
+            return details_map
+        except Exception as e:
+            logger.error("Unexpected error fetching video details: %s", e)
+            return {}
 
-            details_url = (f"https://www.googleapis.com/youtube/v3/videos?part=snippet,contentDetails,statistics&id={','.join(related_ids)}&key={self.api_key}")
-            details_resp = requests.get(details_url, timeout=8)
-            details_map = {item["id"]: item for item in details_resp.json().get("items", [])}
+    def rank_related_videos(self, original_video_id: str, related_ids: List[str],
+                            details_map: Dict[str, dict]) -> Optional[List[dict]]:
+        try:
+            seed = details_map.get(original_video_id)
+            seed_text = f"{seed['title']} {seed['channel_title']}" if seed else ""
 
             candidate_texts = []
-            candidate_objects = []
-            for item in related_items:
-                vid = item["id"].get("videoId")
+            candidates = []
+            # Re-uploads of the same song are vectorized once
+            seen: Set[Tuple[str, str]] = set()
+            for vid in related_ids:
                 details = details_map.get(vid)
-                if not vid or not details: continue
-                snippet = details.get("snippet", {})
-                combined_text = " ".join([snippet.get("title", ""), snippet.get("channelTitle", ""), snippet.get("description", ""), " ".join(snippet.get("tags", []))])
+                if not details: continue
+                key = (details["title"].lower(), details["channel_title"].lower())
+                if key in seen: continue
+                seen.add(key)
+                combined_text = " ".join([details["title"], details["channel_title"], details["description"], " ".join(details["tags"])])
                 candidate_texts.append(combined_text)
-                candidate_objects.append({"title": snippet.get("title", ""), "artist": snippet.get("channelTitle", ""), "youtube_video_id": vid, "score": 1.0})
+                candidates.append((vid, details))
 
-            if not candidate_objects: return None
-            
-            vectorizer = TfidfVectorizer(max_features=5000, stop_words="english")
-            tfidf_matrix = vectorizer.fit_transform([seed_text] + candidate_texts)
-            sims = cosine_similarity(tfidf_matrix[0:1], tfidf_matrix[1:]).flatten()
+            if not candidates: return None
 
-            for i, sim in enumerate(sims):
-                candidate_objects[i]["score"] += 1.5 * float(sim)
+            if len(candidates) < 2 or not seed_text.strip():
+                # Nothing to order by similarity; skip the vectorizer
+                scores = np.ones(len(candidates))
+            else:
+                vectors = text_vectorizer.transform([seed_text] + candidate_texts)
+                # Rows are L2-normalized, so the dot product is the cosine similarity
+                sims = (vectors[1:] @ vectors[0].T).toarray().ravel()
+                scores = 1.0 + 1.5 * sims
 
-            suggestions = sorted(candidate_objects, key=lambda x: x["score"], reverse=True)
-            return suggestions[:10]
+            # Stable sort: equal scores keep YouTube's search-rank order
+            top = np.argsort(-scores, kind="stable")[:10]
+            return [{
+                "title": candidates[i][1]["title"],
+                "artist": candidates[i][1]["channel_title"],
+                "youtube_video_id": candidates[i][0],
+                "score": float(scores[i])
+            } for i in top]
         except Exception as e:
-            logger.error(f"Unexpected error for {song_name}: {str(e)}")
+            logger.error("Unexpected error for %s: %s", original_video_id, e)
             return None
 
-    def get_suggestions_for_songs(self, song_names: List[str]) -> List[dict]:
-        cache_key = "|".join(sorted([s.lower().strip() for s in song_names]))
-        
-        cached = None
+    async def fetch_song_suggestions(self, queries: List[str],
+                                     youtube_cache: Optional[YouTubeCacheRepository] = None) -> Dict[str, List[dict]]:
+        searches: Dict[str, List[str]] = {}
+        if youtube_cache:
+            try:
+                searches = await youtube_cache.get_fresh_searches(queries, SEARCH_RESULT_TTL_SECONDS)
+            except Exception as e:
+                logger.warning("Search result lookup failed: %s", e)
+
+        # Songs are searched concurrently; each search handles its own errors
+        misses = [q for q in queries if q not in searches]
+        results = await asyncio.gather(*(self.search_song_videos(q) for q in misses))
+        new_searches = {q: ids for q, ids in zip(misses, results) if ids}
+        if youtube_cache and new_searches:
+            try:
+                await youtube_cache.save_searches(new_searches)
+            except Exception as e:
+                logger.warning("Search result write failed: %s", e)
+        searches.update(new_searches)
+
+        # The top hit stands in for the liked song; the other hits are its candidates
+        found = {q: searches[q] for q in queries if len(searches.get(q, ())) > 1}
+
+        # One deduplicated details batch covers the seeds and candidates of every song
+        details_map = await self.get_video_details([vid for ids in found.values() for vid in ids], youtube_cache)
+        ranked = {q: self.rank_related_videos(ids[0], ids[1:], details_map) for q, ids in found.items()}
+        return {q: suggestions for q, suggestions in ranked.items() if suggestions}
+
+    async def fetch_song_suggestions_coalesced(self, queries: List[str],
+                                               youtube_cache: Optional[YouTubeCacheRepository] = None) -> Dict[str, List[dict]]:
+        # Songs already being fetched by a concurrent request are awaited rather
+        # than searched again; the rest are fetched here in one batch
+        loop = asyncio.get_running_loop()
+        futures = {q: song_suggestions_inflight.get(q) for q in queries}
+        owned = [q for q, fut in futures.items() if fut is None]
+        for q in owned:
+            futures[q] = song_suggestions_inflight[q] = loop.create_future()
+
+        if owned:
+            fetched: Dict[str, List[dict]] = {}
+            try:
+                fetched = await self.fetch_song_suggestions(owned, youtube_cache)
+                # Only non-empty rankings are cached so failed lookups are retried
+                song_suggestion_cache.update(fetched)
+            finally:
+                for q in owned:
+                    del song_suggestions_inflight[q]
+                    futures[q].set_result(fetched.get(q))
+
+        results: Dict[str, List[dict]] = {}
+        for q, fut in futures.items():
+            # shield: a cancelled waiter must not cancel the owner's future
+            suggestions = await asyncio.shield(fut)
+            if suggestions:
+                results[q] = suggestions
+        return results
+
+    async def get_suggestions_for_songs(self, song_names: List[str],
+                                        youtube_cache: Optional[YouTubeCacheRepository] = None) -> List[dict]:
+        # Fixed-length digest of the song list, so long lists don't make long Redis keys
+        cache_key = hashlib.blake2b(
+            "\x1f".join(sorted(s.lower().strip() for s in song_names)).encode(), digest_size=16
+        ).hexdigest()
+        queries = [q for q in dict.fromkeys(normalize_song_name(s) for s in song_names) if q]
+        per_song = {q: hit for q in queries if (hit := song_suggestion_cache.get(q)) is not None}
+
+        # One MGET covers the combined result and every song this worker hasn't cached
         if self.redis_client:
+            redis_songs = [q for q in queries if q not in per_song]
             try:
-                val = self.redis_client.get(f"suggestions:{cache_key}")
-                if val: cached = json.loads(val)
+                vals = await self.redis_client.mget(
+                    [f"suggestions:{cache_key}"] + [f"yts:{q}" for q in redis_songs]
+                )
+                if vals[0]:
+                    return orjson.loads(vals[0])
+                for q, val in zip(redis_songs, vals[1:]):
+                    if val:
+                        per_song[q] = song_suggestion_cache[q] = orjson.loads(val)
             except Exception as e:
-                logger.warning(f"Redis get failed: {e}")
-        
-        if cached is not None:
-            return cached
+                logger.warning("Redis get failed: %s", e)
+
+        misses = [q for q in queries if q not in per_song]
+        fetched = await self.fetch_song_suggestions_coalesced(misses, youtube_cache) if misses else {}
+        per_song.update(fetched)
 
         all_suggestions = []
         video_id_set = set()
-        for song in song_names:
-            suggestions = self.get_youtube_suggestions(song)
-            if suggestions:
-                for suggestion in suggestions:
-                    if suggestion["youtube_video_id"] not in video_id_set:
-                        all_suggestions.append(suggestion)
-                        video_id_set.add(suggestion["youtube_video_id"])
+        for q in queries:
+            for suggestion in per_song.get(q, ()):
+                if suggestion["youtube_video_id"] not in video_id_set:
+                    all_suggestions.append(suggestion)
+                    video_id_set.add(suggestion["youtube_video_id"])
 
         if not all_suggestions:
             logger.info("No suggestions found from liked songs, triggering fallback.")
-            all_suggestions = self.get_popular_song_fallback() or []
+            all_suggestions = await self.get_popular_song_fallback() or []
 
-        ranked_suggestions = sorted(all_suggestions, key=lambda x: x["score"], reverse=True)
-        unique_suggestions = []
-        seen_titles = set()
-        for suggestion in ranked_suggestions:
+        # Keep the best-scoring suggestion per title, then select the top 5
+        # without sorting the whole list
+        best_by_title: Dict[str, dict] = {}
+        for suggestion in all_suggestions:
             title = suggestion["title"].lower()
-            if title not in seen_titles:
-                unique_suggestions.append(suggestion)
-                seen_titles.add(title)
+            best = best_by_title.get(title)
+            if best is None or suggestion["score"] > best["score"]:
+                best_by_title[title] = suggestion
 
-        result = unique_suggestions[:5]
+        result = heapq.nlargest(5, best_by_title.values(), key=itemgetter("score"))
         if self.redis_client:
             try:
-                self.redis_client.setex(f"suggestions:{cache_key}", self.redis_ttl, json.dumps(result))
+                async with self.redis_client.pipeline(transaction=False) as pipe:
+                    for q, suggestions in fetched.items():
+                        pipe.setex(f"yts:{q}", self.redis_ttl, orjson.dumps(suggestions))
+                    pipe.setex(f"suggestions:{cache_key}", self.redis_ttl, orjson.dumps(result))
+                    await pipe.execute()
             except Exception as e:
-                logger.warning(f"Redis set failed: {e}")
+                logger.warning("Redis set failed: %s", e)
         
         return result
 
 
 # --- DEPENDENCY INJECTION ---
 # These functions provide class instances with database sessions.
-def get_user_repository_read(db_session: Session = Depends(get_read_session)):
+def get_user_repository_read(db_session: AsyncSession = Depends(get_read_session)):
+    return UserRepository(db=db_session)
+
+def get_user_repository_write(db_session: AsyncSession = Depends(get_write_session)):
     return UserRepository(db=db_session)
 
-def get_user_repository_write(db_sessions: List[Session] = Depends(get_write_sessions)):
-    return [UserRepository(db=s) for s in db_sessions]
+def get_youtube_cache_repository(db_session: AsyncSession = Depends(get_write_session)):
+    return YouTubeCacheRepository(db=db_session)
 
+def get_liked_songs_cache():
+    return LikedSongsCache(redis_client=redis_client, ttl=LIKED_SONGS_CACHE_TTL_SECONDS)
+
+# One service per worker: it only holds shared clients, so there is no reason
+# to rebuild it for every request
+@lru_cache(maxsize=1)
 def get_suggestion_service():
     return SuggestionService(
         api_key=YOUTUBE_API_KEY,
         redis_client=redis_client,
-        redis_ttl=REDIS_TTL_SECONDS
+        redis_ttl=REDIS_TTL_SECONDS,
+        http_client=http_client,
+        details_batcher=video_details_batcher
     )
 
 
+# --- BACKGROUND TASKS ---
+async def replicate_user_likes(user_id: str, songs: List[str]) -> None:
+    # Runs after the response is sent, so each replica gets its own session
+    for factory in replica_sessionmakers():
+        try:
+            async with factory() as session:
+                await UserRepository(db=session).persist_user_likes(user_id, songs)
+        except Exception as e:
+            logger.warning("Replicating likes for %s failed: %s", user_id, e)
+
+async def refresh_popular_chart() -> None:
+    service = get_suggestion_service()
+    while True:
+        try:
+            await service.get_popular_chart_items(refresh=True)
+        except Exception as e:
+            logger.warning("Popular chart refresh failed: %s", e)
+        await asyncio.sleep(POPULAR_CHART_REFRESH_SECONDS)
+
+
 # --- API ENDPOINTS ---
 @app.get("/liked-songs", response_model=LikedSongsResponse, summary="Get liked songs",
-         description="Returns the list of liked songs for a given user ID")
+         description="Returns the list of liked songs for a given user ID, optionally one page at a time")
 async def get_liked_songs(
     user_id: str = Query(..., min_length=1, description="User ID to fetch liked songs"),
-    user_repo: UserRepository = Depends(get_user_repository_read)
+    limit: Optional[int] = Query(None, ge=1, le=500, description="Maximum number of songs to return"),
+    after: Optional[str] = Query(None, description="Cursor: next_cursor from the previous page"),
+    user_repo: UserRepository = Depends(get_user_repository_read),
+    liked_songs_cache: LikedSongsCache = Depends(get_liked_songs_cache)
 ):
-    liked_songs = user_repo.get_liked_songs(user_id)
-    return JSONResponse(content={"liked_songs": liked_songs})
+    # Only the unpaged list is cached; pages are cheap index range scans
+    paged = limit is not None or after is not None
+    liked_songs = None if paged else await liked_songs_cache.get(user_id)
+    if liked_songs is None:
+        liked_songs = await user_repo.get_liked_songs(user_id, limit=limit, after=after)
+        if not paged:
+            await liked_songs_cache.set(user_id, liked_songs)
+    next_cursor = liked_songs[-1] if limit is not None and len(liked_songs) == limit else None
+    return ORJSONResponse(content={"liked_songs": liked_songs, "next_cursor": next_cursor})
 
 @app.post("/suggestions", response_model=SuggestionResponse, summary="Get suggestions based on liked songs",
           description="Returns suggestions based on a list of liked songs for a user. Falls back to popular songs if no matches are found.")
 async def post_suggestions(
     request: LikedSongsRequest,
-    user_repos: List[UserRepository] = Depends(get_user_repository_write),
+    background_tasks: BackgroundTasks,
+    user_repo: UserRepository = Depends(get_user_repository_write),
+    youtube_cache: YouTubeCacheRepository = Depends(get_youtube_cache_repository),
+    liked_songs_cache: LikedSongsCache = Depends(get_liked_songs_cache),
     suggestion_service: SuggestionService = Depends(get_suggestion_service)
 ):
     if not YOUTUBE_API_KEY:
@@ -299,17 +870,38 @@ async def post_suggestions(
     if not request.songs:
         raise HTTPException(status_code=400, detail="At least one song must be provided in the request.")
 
-    # Persist likes using all write repositories
-    for repo in user_repos:
-        repo.persist_user_likes(request.user_id, request.songs)
+    # Only the primary commit is awaited; the other databases catch up after the response
+    try:
+        await user_repo.persist_user_likes(request.user_id, request.songs)
+    finally:
+        await liked_songs_cache.invalidate(request.user_id)
+    background_tasks.add_task(replicate_user_likes, request.user_id, request.songs)
 
-    suggestions = suggestion_service.get_suggestions_for_songs(request.songs)
+    suggestions = await suggestion_service.get_suggestions_for_songs(request.songs, youtube_cache)
     
     if not suggestions:
         raise HTTPException(status_code=404, detail="Could not find any suggestions, and the fallback mechanism also failed.")
     
-    return JSONResponse(content={"suggestions": suggestions})
+    return ORJSONResponse(content={"suggestions": suggestions})
 
 @app.get("/health", summary="Health check")
 async def health_check():
     return {"status": "healthy"}
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    # Each worker process imports this module itself, so engines and HTTP/Redis
+    # clients are created per process rather than shared across forks. One
+    # worker unless WEB_CONCURRENCY says otherwise: cpu_count() reports the
+    # host's CPUs inside containers, every worker opens its own DB pool, and
+    # concurrent init_db() calls race on a fresh database.
+    uvicorn.run(
+        "main:app",
+        host=os.getenv("HOST", "0.0.0.0"),
+        port=int(os.getenv("PORT", "8000")),
+        loop="uvloop",
+        http="httptools",
+        workers=int(os.getenv("WEB_CONCURRENCY", "1")),
+    )